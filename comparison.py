@@ -6,17 +6,45 @@ Identifies missing, extra, and newer modules.
 
 import paramiko
 import argparse
+import hashlib
+import json
+import os
 import re
+import shlex
+import sys
+import tempfile
+import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Set, Tuple, Optional
+from operator import attrgetter
+from typing import Dict, Iterator, List, Set, Tuple, Optional
 
-@dataclass
+# Maximum number of concurrent SSH channels per server (OpenSSH MaxSessions defaults to 10)
+MAX_CHANNELS = 8
+
+# Remote script reading module names from stdin and printing "full_name|epoch" for each
+BUILD_TIMES_SCRIPT = (
+    "while read -r m; do "
+    "p=$(module show \"$m\" </dev/null 2>&1 | grep -o '/.*\\.lua' | head -1); "
+    "t=$([ -n \"$p\" ] && stat -c '%Y' \"$p\" 2>/dev/null || echo 'Unknown'); "
+    "printf '%s|%s\\n' \"$m\" \"$t\"; "
+    "done"
+)
+
+# Directory for cached module lists and how long they stay valid (seconds)
+CACHE_DIR = os.path.expanduser("~/.cache/ebcompare")
+CACHE_TTL = 60 * 60
+
+# Matches module names in "ml --terse avail" output
+MODULE_NAME_PATTERN = re.compile(r'/[^/]+$')
+
+@dataclass(slots=True, frozen=True)
 class ModuleInfo:
     """Information about an EasyBuild module"""
     name: str                # Module name
     version: str             # Module version
-    build_time: datetime.datetime  # Build time
+    build_time: int          # Build time (Unix epoch seconds, 0 if unknown)
     full_name: str           # Full module name with version
 
 def parse_arguments():
@@ -26,6 +54,9 @@ def parse_arguments():
     parser.add_argument('-s2', '--server2', required=True, help="Second server (user@hostname)")
     parser.add_argument('-k', '--key', help="Path to private SSH key")
     parser.add_argument('-p', '--password', help="Password for SSH connection")
+    parser.add_argument('--cache', action='store_true',
+                        help="Reuse module lists cached by previous runs in ~/.cache/ebcompare; "
+                             "rebuilt module files are not detected, so build times may be up to an hour stale")
     
     return parser.parse_args()
 
@@ -38,94 +69,233 @@ def connect_to_server(server: str, key_path: Optional[str] = None, password: Opt
     try:
         if key_path:
             key = paramiko.RSAKey.from_private_key_file(key_path)
-            client.connect(hostname=host, username=user, pkey=key)
+            client.connect(hostname=host, username=user, pkey=key, compress=True)
         else:
-            client.connect(hostname=host, username=user, password=password)
+            client.connect(hostname=host, username=user, password=password, compress=True)
+        client.get_transport().set_keepalive(30)
         print(f"Successfully connected to {server}")
         return client
     except Exception as e:
         print(f"Connection error to {server}: {e}")
         raise
 
-def get_modules_list(ssh_client: paramiko.SSHClient) -> List[ModuleInfo]:
-    """Get list of modules from server"""
+def run_command(ssh_client: paramiko.SSHClient, cmd: str, input_data: Optional[str] = None) -> Iterator[str]:
+    """Run command on server in its own channel and yield output lines as they arrive"""
+    with ssh_client.get_transport().open_session() as channel:
+        channel.exec_command(cmd)
+        # Input goes to the command's stdin, which is closed afterwards
+        if input_data is not None:
+            channel.sendall(input_data.encode())
+            channel.shutdown_write()
+        yield from channel.makefile('r')
+
+def make_module_info(full_name: str, build_time: int) -> ModuleInfo:
+    """Create module information from full module name and build time"""
+    # Split full module name into name and version; the version is the last
+    # component, so hierarchical names like "Compiler/GCC/12.2.0" keep their prefix
+    name, sep, version = full_name.rpartition('/')
+    if not sep:
+        name = full_name
+        version = "unknown"
+    
+    # Many modules share the same name, so intern strings to avoid duplicate copies
+    return ModuleInfo(name=sys.intern(name), version=sys.intern(version), build_time=build_time, full_name=full_name)
+
+def scan_module_paths(ssh_client: paramiko.SSHClient, module_paths: List[str]) -> List[ModuleInfo]:
+    """Get list of modules by scanning module directories for module files"""
+    modules = []
+    seen = set()
+    
+    # One directory walk over all module paths; each line is "relative_path<TAB>mtime".
+    # Symlinked module paths and module files are followed. Like Lmod, skip hidden
+    # modules, .modulerc files, "default" markers and editor backups, and accept
+    # files without a .lua extension only if they start with the Tcl "#%Module" header
+    paths = " ".join(shlex.quote(path) for path in module_paths)
+    cmd = (
+        f"find -L {paths} -mindepth 1 \\( -name '.*' -prune \\) -o -type f "
+        "! \\( -name default -o -name '*~' -o -name '*.swp' -o -name '*.bak' -o -name '#*' \\) "
+        "\\( -name '*.lua' -o -exec awk 'NR == 1 { ok = /^#%Module/; exit } END { exit !ok }' {} \\; \\) "
+        "-printf '%P\\t%T@\\n' 2>/dev/null"
+    )
+    for line in run_command(ssh_client, cmd):
+        rel_path, _, mtime = line.strip().partition('\t')
+        if not rel_path or not mtime:
+            continue
+        full_name = rel_path[:-len('.lua')] if rel_path.endswith('.lua') else rel_path
+        
+        # Earlier entries in MODULEPATH take precedence, as in Lmod
+        if full_name in seen:
+            continue
+        seen.add(full_name)
+        
+        try:
+            build_time = int(mtime.partition('.')[0])
+        except ValueError:
+            build_time = 0
+        
+        modules.append(make_module_info(full_name, build_time))
+    
+    return modules
+
+def run_build_times_script(ssh_client: paramiko.SSHClient, module_names: List[str]) -> Optional[List[str]]:
+    """Run build times script for modules, return None if the server refuses to open a channel"""
+    # Module names are sent on stdin, since the command line length is limited
+    try:
+        return list(run_command(ssh_client, BUILD_TIMES_SCRIPT, "\n".join(module_names) + "\n"))
+    except paramiko.ChannelException:
+        return None
+
+def get_modules_from_lmod(ssh_client: paramiko.SSHClient) -> List[ModuleInfo]:
+    """Get list of modules from server using Lmod commands"""
     modules = []
     
     # Get list of modules
-    stdin, stdout, stderr = ssh_client.exec_command("ml --terse avail 2>&1 | grep -E '/[^/]+$' | grep -v ':$'")
-    module_names = [line.strip() for line in stdout.readlines()]
+    # Keep only "name/version" entries, skipping module path headers ending with ':'
+    output = run_command(ssh_client, "ml --terse avail 2>&1")
+    module_names = [line for line in map(str.strip, output) if MODULE_NAME_PATTERN.search(line) and not line.endswith(':')]
+    
+    # Request build times with a remote script instead of one round trip per
+    # module; the names are split across several channels on the same
+    # connection so that module show runs in parallel on the server
+    chunks = [chunk for chunk in (module_names[i::MAX_CHANNELS] for i in range(MAX_CHANNELS)) if chunk]
+    with ThreadPoolExecutor(max_workers=MAX_CHANNELS) as executor:
+        outputs = list(executor.map(lambda chunk: run_build_times_script(ssh_client, chunk), chunks))
+    
+    build_times = {}
+    for chunk, output in zip(chunks, outputs):
+        # The server refused to open this channel (e.g. a low MaxSessions limit),
+        # so run the chunk again now that the other channels are closed
+        if output is None:
+            output = list(run_command(ssh_client, BUILD_TIMES_SCRIPT, "\n".join(chunk) + "\n"))
+        for line in output:
+            full_name, _, build_time_str = line.strip().rpartition('|')
+            if full_name:
+                build_times[full_name] = build_time_str
     
     for full_name in module_names:
-        # For each module, request information about build time
-        # Assuming build time can be found in module metadata or in the filesystem
-        cmd = f"stat -c '%z' $(module show {full_name} 2>&1 | grep -o '/.*\\.lua' | head -1) 2>/dev/null || echo 'Unknown'"
-        stdin, stdout, stderr = ssh_client.exec_command(cmd)
-        build_time_str = stdout.read().decode().strip()
+        build_time_str = build_times.get(full_name, 'Unknown')
+        build_time = int(build_time_str) if build_time_str.isdigit() else 0  # 0 if build time is unknown
         
-        try:
-            if build_time_str != 'Unknown':
-                build_time = datetime.datetime.strptime(build_time_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
-            else:
-                build_time = datetime.datetime(1970, 1, 1)  # If build time is unknown
-        except ValueError:
-            build_time = datetime.datetime(1970, 1, 1)
+        modules.append(make_module_info(full_name, build_time))
+    
+    return modules
+
+def get_cache_path(server: str) -> str:
+    """Get path to the module cache file for server"""
+    host = server.split('@')[-1]
+    return os.path.join(CACHE_DIR, f"{host}.json")
+
+def get_module_paths_fingerprint(ssh_client: paramiko.SSHClient, module_paths: List[str]) -> str:
+    """Get fingerprint of modification times of module directories"""
+    # Module files usually live in <path>/<name>/, so stat the module paths and
+    # their subdirectories; adding or removing such a module changes one of these
+    # mtimes, but deeper names and files rewritten in place are not detected.
+    # Symlinks are followed, as in the find -L scan
+    paths = " ".join(f"{shlex.quote(path)} {shlex.quote(path)}/*" for path in module_paths)
+    output = run_command(ssh_client, f"stat -L -c '%n %Y' {paths} 2>/dev/null")
+    return hashlib.sha1("".join(output).encode()).hexdigest()
+
+def load_cached_modules(cache_path: str, module_paths: List[str], fingerprint: str) -> Optional[List[ModuleInfo]]:
+    """Load modules from cache if it is still valid"""
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
         
-        # Split full module name into name and version
-        parts = full_name.split('/')
-        if len(parts) >= 2:
-            name = parts[0]
-            version = parts[1]
-        else:
-            name = full_name
-            version = "unknown"
+        # Directory mtimes do not change when a module file is rewritten in place,
+        # so cached results are only trusted for CACHE_TTL seconds
+        if (cache['module_paths'] != module_paths or cache['fingerprint'] != fingerprint
+                or time.time() - cache['created'] > CACHE_TTL):
+            return None
         
-        modules.append(ModuleInfo(name=name, version=version, build_time=build_time, full_name=full_name))
+        return [make_module_info(full_name, build_time) for full_name, build_time in cache['modules']]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_cached_modules(cache_path: str, module_paths: List[str], fingerprint: str, modules: List[ModuleInfo]):
+    """Save modules to cache"""
+    cache = {
+        'module_paths': module_paths,
+        'fingerprint': fingerprint,
+        'created': time.time(),
+        'modules': [(module.full_name, module.build_time) for module in modules],
+    }
+    
+    # Write to a temporary file first, so another thread or run reading the
+    # same cache file never sees a partially written one
+    tmp_path = None
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as f:
+            tmp_path = f.name
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # Do not leave the temporary file behind in the cache directory
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        print(f"Could not save module cache to {cache_path}: {e}")
+
+def get_modules_list(ssh_client: paramiko.SSHClient, cache_path: Optional[str] = None) -> List[ModuleInfo]:
+    """Get list of modules from server, using cache file if given"""
+    # Scanning module directories directly avoids running Lmod for every module
+    output = run_command(ssh_client, "echo $MODULEPATH")
+    module_paths = [path for path in "".join(output).strip().split(':') if path]
+    
+    if not module_paths:
+        return get_modules_from_lmod(ssh_client)
     
+    if not cache_path:
+        return scan_module_paths(ssh_client, module_paths) or get_modules_from_lmod(ssh_client)
+    
+    # Skip the full scan if nothing has changed since the previous run
+    fingerprint = get_module_paths_fingerprint(ssh_client, module_paths)
+    modules = load_cached_modules(cache_path, module_paths, fingerprint)
+    if modules is not None:
+        return modules
+    
+    # Never cache an empty scan; the Lmod fallback result is not cached either
+    modules = scan_module_paths(ssh_client, module_paths)
+    if not modules:
+        return get_modules_from_lmod(ssh_client)
+    save_cached_modules(cache_path, module_paths, fingerprint, modules)
     return modules
 
-def compare_modules(modules1: List[ModuleInfo], modules2: List[ModuleInfo]) -> Tuple[List[ModuleInfo], List[ModuleInfo], List[Tuple[ModuleInfo, ModuleInfo]]]:
+def format_build_time(build_time: int) -> str:
+    """Format build time for output"""
+    if build_time == 0:
+        return 'Unknown'
+    return str(datetime.datetime.fromtimestamp(build_time))
+
+def compare_modules(modules1: List[ModuleInfo], modules2: List[ModuleInfo]) -> Tuple[List[ModuleInfo], List[ModuleInfo], List[Tuple[ModuleInfo, ModuleInfo, int, int]]]:
     """
     Compare modules on two servers
     
     Returns a tuple of three elements:
     1. List of modules present only on the first server
     2. List of modules present only on the second server
-    3. List of module pairs (module1, module2), where module1 is older than module2
+    3. List of tuples (module1, module2, server1_idx, server2_idx), where module1 is
+       older than module2 and the indices (0 or 1) tell which server each module is on
     """
     # Create dictionaries for quick access
     modules_dict1 = {module.full_name: module for module in modules1}
     modules_dict2 = {module.full_name: module for module in modules2}
     
     # Find unique modules
-    unique_modules1 = [module for name, module in modules_dict1.items() if name not in modules_dict2]
-    unique_modules2 = [module for name, module in modules_dict2.items() if name not in modules_dict1]
+    unique_modules1 = [modules_dict1[name] for name in modules_dict1.keys() - modules_dict2.keys()]
+    unique_modules2 = [modules_dict2[name] for name in modules_dict2.keys() - modules_dict1.keys()]
     
     # Find modules with different build times
     newer_modules = []
     
-    # First group modules by base name (without version)
-    modules_by_name1 = {}
-    modules_by_name2 = {}
-    
-    for module in modules1:
-        if module.name not in modules_by_name1:
-            modules_by_name1[module.name] = []
-        modules_by_name1[module.name].append(module)
-    
-    for module in modules2:
-        if module.name not in modules_by_name2:
-            modules_by_name2[module.name] = []
-        modules_by_name2[module.name].append(module)
-    
-    # Now compare versions for each base name
-    for name in set(modules_by_name1.keys()) & set(modules_by_name2.keys()):
-        for mod1 in modules_by_name1[name]:
-            for mod2 in modules_by_name2[name]:
-                if mod1.version == mod2.version and mod1.build_time != mod2.build_time:
-                    if mod1.build_time < mod2.build_time:
-                        newer_modules.append((mod1, mod2))
-                    else:
-                        newer_modules.append((mod2, mod1))
+    # Match modules with the same full name on both servers
+    for full_name, mod1 in modules_dict1.items():
+        mod2 = modules_dict2.get(full_name)
+        if mod2 is not None and mod1.build_time != mod2.build_time:
+            if mod1.build_time < mod2.build_time:
+                newer_modules.append((mod1, mod2, 0, 1))
+            else:
+                newer_modules.append((mod2, mod1, 1, 0))
     
     return unique_modules1, unique_modules2, newer_modules
 
@@ -137,14 +307,17 @@ def main():
         ssh1 = connect_to_server(args.server1, args.key, args.password)
         ssh2 = connect_to_server(args.server2, args.key, args.password)
         
-        # Get module lists
-        print(f"Getting module list from server {args.server1}...")
-        modules1 = get_modules_list(ssh1)
-        print(f"Found {len(modules1)} modules")
-        
-        print(f"Getting module list from server {args.server2}...")
-        modules2 = get_modules_list(ssh2)
-        print(f"Found {len(modules2)} modules")
+        # Get module lists from both servers concurrently
+        print(f"Getting module lists from servers {args.server1} and {args.server2}...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            cache_path1 = get_cache_path(args.server1) if args.cache else None
+            cache_path2 = get_cache_path(args.server2) if args.cache else None
+            future1 = executor.submit(get_modules_list, ssh1, cache_path1)
+            future2 = executor.submit(get_modules_list, ssh2, cache_path2)
+            modules1 = future1.result()
+            modules2 = future2.result()
+        print(f"Found {len(modules1)} modules on {args.server1}")
+        print(f"Found {len(modules2)} modules on {args.server2}")
         
         # Compare modules
         unique_modules1, unique_modules2, newer_modules = compare_modules(modules1, modules2)
@@ -153,24 +326,25 @@ def main():
         print("\n" + "="*80)
         print(f"Modules present only on {args.server1} ({len(unique_modules1)}):")
         print("="*80)
-        for module in sorted(unique_modules1, key=lambda m: m.full_name):
-            print(f"{module.full_name} (build: {module.build_time})")
+        for module in sorted(unique_modules1, key=attrgetter('full_name')):
+            print(f"{module.full_name} (build: {format_build_time(module.build_time)})")
         
         print("\n" + "="*80)
         print(f"Modules present only on {args.server2} ({len(unique_modules2)}):")
         print("="*80)
-        for module in sorted(unique_modules2, key=lambda m: m.full_name):
-            print(f"{module.full_name} (build: {module.build_time})")
+        for module in sorted(unique_modules2, key=attrgetter('full_name')):
+            print(f"{module.full_name} (build: {format_build_time(module.build_time)})")
         
         print("\n" + "="*80)
         print(f"Modules with different build times ({len(newer_modules)}):")
         print("="*80)
-        for older, newer in sorted(newer_modules, key=lambda pair: pair[0].full_name):
-            server_older = args.server1 if older in modules1 else args.server2
-            server_newer = args.server1 if newer in modules1 else args.server2
+        servers = (args.server1, args.server2)
+        for older, newer, older_idx, newer_idx in sorted(newer_modules, key=lambda entry: entry[0].full_name):
+            server_older = servers[older_idx]
+            server_newer = servers[newer_idx]
             print(f"Module: {older.full_name}")
-            print(f"  On {server_older}: {older.build_time}")
-            print(f"  On {server_newer}: {newer.build_time}")
+            print(f"  On {server_older}: {format_build_time(older.build_time)}")
+            print(f"  On {server_newer}: {format_build_time(newer.build_time)}")
             print(f"  Newer version on {server_newer}")
             print()
         